@@ -31,37 +31,35 @@
 #
 ##############################################################################
 
-import io  # used to create file streams
-from io import open
+import atexit
 import os
 import fcntl  # used to access I2C parameters like addresses
 import cymysql
-import cymysql.cursors
 
 import time  # used for sleep delay and timestamps
-import string  # helps parse strings
 
-from datetime import datetime, timedelta
-
-from collections import OrderedDict
-
-import smtplib
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 
 
 class AtlasI2C:
-    long_timeout = 1.5  # the timeout needed to query readings and calibrations
+    long_timeout = 1.5  # the worst-case timeout for readings and calibrations
     short_timeout = 0.5  # timeout for regular commands
+    poll_interval = 0.1  # delay between ready-byte polls while a command runs
     default_bus = 1  # the default bus for I2C on the newer Raspberry Pis, certain older boards use bus 0
     default_address = 102  # the default address for the temperature sensor
     current_addr = default_address
 
+    # translation table that clears the MSB of every byte in one C-level
+    # pass, instead of mapping chr(x & ~0x80) over each byte in Python
+    _MSB_MASK = bytes(i & 0x7F for i in range(256))
+
     def __init__(self, address=default_address, bus=default_bus):
-        # open two file streams, one for reading and one for writing
+        # open one raw file descriptor for both reading and writing
         # the specific I2C channel is selected with bus
         # it is usually 1, except for older revisions where its 0
-        # wb and rb indicate binary read and write
-        self.file_read = io.open("/dev/i2c-" + str(bus), "rb", buffering=0)
-        self.file_write = io.open("/dev/i2c-" + str(bus), "wb", buffering=0)
+        # os.read/os.write go straight to the kernel with no buffering layer
+        self._fd = os.open("/dev/i2c-" + str(bus), os.O_RDWR)
 
         # initializes I2C to either a user specified or default address
         self.set_i2c_address(address)
@@ -71,62 +69,69 @@ class AtlasI2C:
         # The commands for I2C dev using the ioctl functions are specified in
         # the i2c-dev.h file from i2c-tools
         I2C_SLAVE = 0x703
-        fcntl.ioctl(self.file_read, I2C_SLAVE, addr)
-        fcntl.ioctl(self.file_write, I2C_SLAVE, addr)
+        fcntl.ioctl(self._fd, I2C_SLAVE, addr)
         self.current_addr = addr
 
     def write(self, cmd):
-        # appends the null character and sends the string over I2C
-        cmd += "\00"
-        self.file_write.write(cmd.encode("UTF-8"))
+        # appends the null character and sends the command over I2C
+        os.write(self._fd, cmd.encode("ascii") + b"\x00")
 
     def read(self, num_of_bytes=31):
         # reads a specified number of bytes from I2C, then parses and displays the result
-        res = self.file_read.read(num_of_bytes)  # read from the board
-        if type(res[0]) is str:  # if python2 read
-            response = [i for i in res]
-            if ord(response[0]) == 1:  # if the response isn't an error
-                # change MSB to 0 for all received characters except the first and get a list of characters
-                # NOTE: having to change the MSB to 0 is a glitch in the raspberry pi, and you shouldn't have to do this!
-                char_list = list(map(lambda x: chr(ord(x) & ~0x80), list(response[1:])))
-                result = "".join(char_list)
-                return result.split("\x00")[
-                    0
-                ]  # convert the char list to a string and returns it
-
-            else:
-                return "Error " + str(ord(response[0]))
-
-        else:  # if python3 read
-            if res[0] == 1:
-                # change MSB to 0 for all received characters except the first and get a list of characters
-                # NOTE: having to change the MSB to 0 is a glitch in the raspberry pi, and you shouldn't have to do this!
-                char_list = list(map(lambda x: chr(x & ~0x80), list(res[1:])))
-                result = "".join(char_list)
-                return result.split("\x00")[
-                    0
-                ]  # convert the char list to a string and returns it
-
-            else:
-                return "Error " + str(res[0])
+        res = os.read(self._fd, num_of_bytes)  # read from the board
+        return self.parse_response(res)
+
+    def parse_response(self, res):
+        if res[0] == 1:  # if the response isn't an error
+            # change MSB to 0 for all received characters except the first
+            # NOTE: having to change the MSB to 0 is a glitch in the raspberry pi, and you shouldn't have to do this!
+            payload = res[1:].translate(self._MSB_MASK)
+            return payload.split(b"\x00", 1)[0].decode("ascii")
+
+        else:
+            return "Error " + str(res[0])
+
+    def write_cmd(self, cmd):
+        # send a command without waiting for it to finish - the caller
+        # sleeps once for a whole batch of sensors and then collects each
+        # response with read_response()
+        self.write(cmd)
+
+    def read_response(self, num_of_bytes=31):
+        # collect the response to an earlier write_cmd(). The board answers
+        # 254 (still processing) or 255 (no data) in the first byte until
+        # the conversion is done, so poll in short steps up to the old
+        # worst-case timeout instead of sleeping it blindly
+        res = os.read(self._fd, num_of_bytes)
+        for _ in range(int(self.long_timeout / self.poll_interval)):
+            if res[0] not in (254, 255):
+                break
+            time.sleep(self.poll_interval)
+            res = os.read(self._fd, num_of_bytes)
+        return self.parse_response(res)
 
     def query(self, string):
-        # write a command to the board, wait the correct timeout, and read the response
+        # write a command to the board, then poll until the sensor signals
+        # the response is ready and read it
         self.write(string)
 
-        # the read and calibration commands require a longer timeout
-        if (string.upper().startswith("R")) or (string.upper().startswith("CAL")):
-            time.sleep(self.long_timeout)
-        elif string.upper().startswith("SLEEP"):
+        if string.upper().startswith("SLEEP"):
             return "sleep mode"
-        else:
-            time.sleep(self.short_timeout)
 
-        return self.read()
+        time.sleep(self.poll_interval)
+        return self.read_response()
 
     def close(self):
-        self.file_read.close()
-        self.file_write.close()
+        os.close(self._fd)
+
+
+# A connected sensor and its long-lived device. Attribute access on a
+# namedtuple is a C-level offset, cheaper than the per-field dict lookups
+# the read loop used to do against the sensors OrderedDict
+
+SensorRecord = namedtuple(
+    "SensorRecord", ["name", "sensor_type", "accuracy", "is_ref", "device"]
+)
 
 
 # Create required database in the MySQL if it doesn't' already exist
@@ -137,7 +142,7 @@ def create_database():
     curs = conn.cursor()
     curs.execute("SET sql_notes = 0; ")  # Hide Warnings
 
-    curs.execute("CREATE DATABASE IF NOT EXISTS {}".format(dbname))
+    curs.execute("CREATE DATABASE IF NOT EXISTS `{}`".format(dbname))
 
     curs.execute("SET sql_notes = 1; ")  # Show Warnings
     conn.commit()
@@ -146,60 +151,92 @@ def create_database():
 
 
 def open_database_connection():
-    conn = cymysql.connect(servername, username, password, dbname)
-    curs = conn.cursor()
-    curs.execute("SET sql_notes = 0; ")  # Hide Warnings
+    # Open the single long-lived connection used for every cycle
+    global db_connection
+    db_connection = cymysql.connect(servername, username, password, dbname)
+    return
 
-    return conn, curs
 
-
-def close_database_connection(conn, curs):
-    curs.execute("SET sql_notes = 1; ")
-    conn.commit()
-    conn.close()
+@contextmanager
+def database_cursor():
+    # Yield a cursor on the persistent connection, reconnecting if the
+    # server has dropped it, and commit on the way out without closing
+    db_connection.ping(reconnect=True)
+    curs = db_connection.cursor()
+    try:
+        yield curs
+    finally:
+        db_connection.commit()
+        curs.close()
 
 
-def create_sensors_table():
-    conn, curs = open_database_connection()
+def existing_sensor_columns(curs):
+    # The columns currently on the sensors table, so the ALTERs below are
+    # only issued for the delta instead of being tried blind and failing
+    curs.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = %s AND table_name = 'sensors';",
+        (dbname,),
+    )
+    return set(row[0] for row in curs.fetchall())
 
-    curs.execute("CREATE TABLE IF NOT EXISTS sensors (timestamp DATETIME);")
 
-    for key, value in list(sensors.items()):
-        if value["is_connected"] is True:
-            try:
+def create_sensors_table():
+    with database_cursor() as curs:
+        # IF NOT EXISTS raises a note when the table is already in
+        # place, so hide warnings for this statement only
+        curs.execute("SET sql_notes = 0; ")  # Hide Warnings
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS sensors ("
+            "id INT AUTO_INCREMENT PRIMARY KEY, "
+            "timestamp DATETIME, "
+            "INDEX ix_sensors_ts (timestamp DESC));"
+        )
+        curs.execute("SET sql_notes = 1; ")  # Show Warnings
+
+        # Older installs predate the timestamp index and MySQL has no
+        # CREATE INDEX IF NOT EXISTS, so check information_schema first.
+        # Without it the ORDER BY timestamp DESC LIMIT 1 in
+        # search_database filesorts the whole table every cycle
+        curs.execute(
+            "SELECT COUNT(*) FROM information_schema.statistics "
+            "WHERE table_schema = %s AND table_name = 'sensors' "
+            "AND index_name = 'ix_sensors_ts';",
+            (dbname,),
+        )
+        if curs.fetchone()[0] == 0:
+            curs.execute("CREATE INDEX ix_sensors_ts ON sensors (timestamp DESC);")
+
+        existing = existing_sensor_columns(curs)
+        for record in connected_sensors:
+            if record.name not in existing:
                 curs.execute(
-                    "ALTER TABLE sensors ADD {} DECIMAL(10,2);".format(value["name"])
+                    "ALTER TABLE sensors ADD `{}` DECIMAL(10,2);".format(record.name)
                 )
-            except:
-                pass
-
-    close_database_connection(conn, curs)
 
     return
 
 
 def remove_unused_sensors():
-    conn, curs = open_database_connection()
-
-    for key, value in list(sensors.items()):
-        if value["is_connected"] is False:
-            try:
-                curs.execute("ALTER TABLE sensors DROP {};".format(value["name"]))
-            except:
-                pass
-
-    close_database_connection(conn, curs)
+    with database_cursor() as curs:
+        existing = existing_sensor_columns(curs)
+        for key, value in list(sensors.items()):
+            if value["is_connected"] is False and value["name"] in existing:
+                curs.execute("ALTER TABLE sensors DROP `{}`;".format(value["name"]))
 
     return
 
 
 def search_database():
-    conn, curs = open_database_connection()
-
-    curs.execute("SELECT * FROM sensors ORDER BY `timestamp` DESC LIMIT 1;")
-    result = curs.fetchall()
-
-    close_database_connection(conn, curs)
+    # Fetch the most recent row of readings, naming the columns so the
+    # result order always matches the connected sensors
+    with database_cursor() as curs:
+        curs.execute(
+            "SELECT "
+            + ", ".join("`{}`".format(col) for col in sensor_columns)
+            + " FROM sensors ORDER BY `timestamp` DESC LIMIT 1;"
+        )
+        result = curs.fetchone()
 
     return result
 
@@ -207,61 +244,106 @@ def search_database():
 # read and log each sensor if it is set to True in the sensors list
 
 
-def log_sensor_readings(all_curr_readings):
-    # Create a timestamp and store all readings on the MySQL database
-
-    conn, curs = open_database_connection()
+def prepare_insert_statement():
+    # Build the per-cycle INSERT statement once at startup. The connected
+    # sensors never change while the program runs, so the statement shape
+    # is fixed and only the values need binding each cycle.
+    global insert_sql, sensor_columns
+    # Temperature sensors are read (and therefore logged) first, so the
+    # column order here has to match read_sensors
+    cols = [
+        record.name
+        for record in connected_sensors
+        if record.sensor_type == "atlas_scientific_temp"
+    ]
+    cols += [
+        record.name
+        for record in connected_sensors
+        if record.sensor_type != "atlas_scientific_temp"
+    ]
+    insert_sql = (
+        "INSERT INTO sensors (timestamp, "
+        + ", ".join("`{}`".format(col) for col in cols)
+        + ") VALUES (now(), "
+        + ", ".join(["%s"] * len(cols))
+        + ");"
+    )
+    sensor_columns = cols
+    return
 
-    curs.execute("INSERT INTO sensors (timestamp) VALUES(now());")
-    curs.execute("SELECT MAX(timestamp) FROM sensors")
-    last_timestamp = curs.fetchone()
-    last_timestamp = last_timestamp[0].strftime("%Y-%m-%d %H:%M:%S")
 
-    for readings in all_curr_readings:
-        try:
-            curs.execute(
-                ("UPDATE sensors SET {} = {} WHERE timestamp = '{}'").format(
-                    readings[0], readings[1], last_timestamp
-                )
-            )
-        except:
-            pass
+def log_sensor_readings(all_curr_readings):
+    # Create a timestamp and store all readings on the MySQL database
+    # in a single multi-column INSERT rather than one UPDATE per sensor
 
-    close_database_connection(conn, curs)
+    vals = [readings[1] for readings in all_curr_readings]
+    with database_cursor() as curs:
+        curs.execute(insert_sql, vals)
 
     return
 
 
 def read_sensors():
+    global last_ref_temp
     all_curr_readings = []
     ref_temp = 25
 
-    # Get the readings from any Atlas Scientific temperature sensors
-
-    for key, value in list(sensors.items()):
-        if value["is_connected"] is True:
-            if value["sensor_type"] == "atlas_scientific_temp":
-                device = AtlasI2C(value["i2c"])
-                sensor_reading = round(float(device.query("R")), value["accuracy"])
-                all_curr_readings.append([value["name"], sensor_reading])
-                if value["is_ref"] is True:
-                    ref_temp = sensor_reading
-
-            else:
-                device = AtlasI2C(value["i2c"])
-                # Set reference temperature value on the sensor
-                device.query("T," + str(ref_temp))
-
-                # Get the readings from any Atlas Scientific Elec Conductivity sensors
+    # Each sensor sits on its own I2C address, so commands can be issued
+    # back to back and the conversion timeout slept once per batch rather
+    # than once per sensor.
 
-                if value["sensor_type"] == "atlas_scientific_ec":
-                    sensor_reading = round(float(device.query("R")), value["accuracy"])
-
-                # Get the readings from any other Atlas Scientific sensors
+    # Get the readings from any Atlas Scientific temperature sensors
 
-                else:
-                    sensor_reading = round(float(device.query("R")), value["accuracy"])
-                all_curr_readings.append([value["name"], sensor_reading])
+    pending = 0
+    for record in connected_sensors:
+        if record.sensor_type == "atlas_scientific_temp":
+            record.device.write_cmd("R")
+            pending += 1
+    if pending > 0:
+        # sleep the typical conversion time once for the whole batch;
+        # read_response polls the ready byte for any remainder
+        time.sleep(AtlasI2C.short_timeout)
+
+    for record in connected_sensors:
+        if record.sensor_type == "atlas_scientific_temp":
+            sensor_reading = round(float(record.device.read_response()), record.accuracy)
+            all_curr_readings.append([record.name, sensor_reading])
+            if record.is_ref is True:
+                ref_temp = sensor_reading
+
+    # Set the reference temperature value on the other sensors, but only
+    # when it has moved since last cycle - each "T," command costs a full
+    # I2C write plus the short timeout sleep
+
+    if last_ref_temp is None or abs(ref_temp - last_ref_temp) >= 0.1:
+        pending = 0
+        for record in connected_sensors:
+            if record.sensor_type != "atlas_scientific_temp":
+                record.device.write_cmd("T," + str(ref_temp))
+                pending += 1
+        if pending > 0:
+            time.sleep(AtlasI2C.short_timeout)
+        for record in connected_sensors:
+            if record.sensor_type != "atlas_scientific_temp":
+                record.device.read_response()
+        last_ref_temp = ref_temp
+
+    # Get the readings from any other Atlas Scientific sensors
+
+    pending = 0
+    for record in connected_sensors:
+        if record.sensor_type != "atlas_scientific_temp":
+            record.device.write_cmd("R")
+            pending += 1
+    if pending > 0:
+        # sleep the typical conversion time once for the whole batch;
+        # read_response polls the ready byte for any remainder
+        time.sleep(AtlasI2C.short_timeout)
+
+    for record in connected_sensors:
+        if record.sensor_type != "atlas_scientific_temp":
+            sensor_reading = round(float(record.device.read_response()), record.accuracy)
+            all_curr_readings.append([record.name, sensor_reading])
 
     log_sensor_readings(all_curr_readings)
 
@@ -269,42 +351,36 @@ def read_sensors():
 
 
 def notify():
-    search_database()
     global email_time
-    # To email notifications
-    for x in search_database():
-        if x[1] < temp_min or x[1] > temp_max:
-            if datetime.now() >= email_time:
-                with smtplib.SMTP(smtp_server, port) as server:
-                    server.sendmail(
-                        sender_email,
-                        receiver_email,
-                        message.format("temperature", x[1], "C"),
-                    )
-                    server.quit()
-                    email_time = datetime.now() + timedelta(seconds=email_delay)
-
-        if x[2] < ph_min or x[2] > ph_max:
-            if datetime.now() >= email_time:
-                with smtplib.SMTP(smtp_server, port) as server:
-                    server.sendmail(
-                        sender_email, receiver_email, message.format("pH", x[2], " ")
-                    )
-                    server.quit()
-                    email_time = datetime.now() + timedelta(seconds=email_delay)
-
-        if x[3] < sal_min or x[3] > sal_max:
-            if datetime.now() >= email_time:
-                with smtplib.SMTP(smtp_server, port) as server:
-                    server.sendmail(
-                        sender_email,
-                        receiver_email,
-                        message.format("salinity", x[3], " ppt"),
-                    )
-                    server.quit()
-                    email_time = datetime.now() + timedelta(seconds=email_delay)
-        else:
-            email_time = datetime.now()
+    # To email notifications. LIMIT 1 returns a single row, so fetch it
+    # once and look sensors up by name - a sensor that is not connected
+    # simply has no entry and its check is skipped
+    row = search_database()
+    if row is None:
+        return email_time
+    readings = dict(zip(sensor_columns, row))
+
+    alerts = []
+    for column, label, unit, low, high in thresholds:
+        value = readings.get(column)
+        if value is not None and (value < low or value > high):
+            alerts.append((label, value, unit))
+
+    # one consistent notion of "now" for the whole check; monotonic time
+    # cannot jump backwards when NTP adjusts the Pi's wall clock
+    now = time.monotonic()
+    if alerts and now >= email_time:
+        # smtplib is only needed when a threshold is actually crossed,
+        # which is rare - importing it here keeps it out of startup on
+        # the Pi. One SMTP session sends every alert raised this cycle
+        import smtplib
+
+        with smtplib.SMTP(smtp_server, port) as server:
+            for label, value, unit in alerts:
+                server.sendmail(
+                    sender_email, receiver_email, message.format(label, value, unit)
+                )
+        email_time = now + email_delay
 
     return email_time
 
@@ -368,6 +444,33 @@ sensors = OrderedDict(
     ]
 )
 
+# Pre-compute the connected sensors once at startup. Each record keeps a
+# long-lived AtlasI2C device, so /dev/i2c-* is opened and the I2C address
+# set once rather than on every 5 minute cycle.
+
+connected_sensors = [
+    SensorRecord(
+        name=value["name"],
+        sensor_type=value["sensor_type"],
+        accuracy=value["accuracy"],
+        is_ref=value["is_ref"],
+        device=AtlasI2C(value["i2c"]),
+    )
+    for value in sensors.values()
+    if value["is_connected"] is True
+]
+
+# The devices stay open for the life of the program, so close the I2C
+# file streams cleanly on exit
+
+for record in connected_sensors:
+    atexit.register(record.device.close)
+
+# Reference temperature sent to the sensors on the previous cycle, None
+# until the first cycle has run
+
+last_ref_temp = None
+
 # Define MySQL database login settings
 
 servername = "localhost"
@@ -375,6 +478,16 @@ username = "username"
 password = "password"
 dbname = "Aquarium_Monitor"
 
+# Persistent connection, opened once at startup by open_database_connection()
+
+db_connection = None
+
+# Per-cycle INSERT statement and the matching column order, built once at
+# startup by prepare_insert_statement()
+
+insert_sql = None
+sensor_columns = None
+
 # Define SMTP email settings
 smtp_server = "smtp.email.com"
 port = 25
@@ -385,9 +498,15 @@ Subject: Reef Alert!!!
 
 Warning: Reef {} is {}{}"""
 
+# Define the sensor logging interval in seconds
+
+sample_interval = 300
+
 # Define notification settings
 
-email_time = datetime.now()
+# email_time is a time.monotonic() deadline for the next allowed alert
+
+email_time = 0.0
 email_delay = 21600
 temp_min = 24
 temp_max = 28
@@ -396,6 +515,14 @@ ph_max = 8.8
 sal_min = 30
 sal_max = 37
 
+# Alert thresholds checked by notify(): column, label, unit, minimum, maximum
+
+thresholds = [
+    ("Temp", "temperature", "C", temp_min, temp_max),
+    ("pH", "pH", " ", ph_min, ph_max),
+    ("Salinity", "salinity", " ppt", sal_min, sal_max),
+]
+
 #################
 #               #
 # Main Program  #
@@ -406,10 +533,18 @@ sal_max = 37
 # Build/Remove MySQL Database Entries
 
 create_database()
+open_database_connection()
 create_sensors_table()
 remove_unused_sensors()
+prepare_insert_statement()
+
+# Schedule cycles against a monotonic deadline so the interval does not
+# drift by however long the sensor reads and notifications take
+
+next_tick = time.monotonic()
 
 while True:  # Repeat the code indefinitely
     read_sensors()
     notify()
-    time.sleep(300)
+    next_tick += sample_interval
+    time.sleep(max(0, next_tick - time.monotonic()))